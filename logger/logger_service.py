@@ -6,14 +6,17 @@ No read or modify capabilities to prevent exploitation if main container is comp
 
 import os
 import sys
-import json
+import gzip
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel, Field
+from fastapi import Depends, FastAPI, HTTPException, Request
 import uvicorn
-import hashlib
 import hmac
+import msgspec
 
 def strip_quotes(value: str) -> str:
     """Strip surrounding quotes from environment variable values if present."""
@@ -29,96 +32,238 @@ def get_env(key: str, default: str = None) -> str:
         return strip_quotes(value)
     return value
 
+# Per-request diagnostics are only emitted when DEBUG is set
+DEBUG = get_env("DEBUG", "false").lower() in ["true", "1", "yes"]
+logging.basicConfig(
+    stream=sys.stderr,
+    level=logging.DEBUG if DEBUG else logging.WARNING,
+    format="%(levelname)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
 # Generate a random secret key for HMAC authentication
 # In production, this should be set via environment variable shared only with main container
 LOGGER_SECRET = get_env("LOGGER_SECRET", "default-secret-change-me")
+# Keyed once at startup; each signature check copy()s it instead of rekeying
+HMAC_TEMPLATE = hmac.new(LOGGER_SECRET.encode(), digestmod="sha256")
+
+# Encodes each log frame; reused across requests
+FRAME_ENCODER = msgspec.msgpack.Encoder()
+
+# Frames are buffered and hit the disk in large sequential writes, but
+# never sit in memory longer than LOG_FLUSH_SECONDS
+LOG_BUFFER_SIZE = 256 * 1024
+LOG_FLUSH_SECONDS = 1.0
+
+# Created at startup; must exist before any log file is opened
+LOG_DIR = Path("/logs")
+
+def open_log_file(day: str):
+    """Open (creating if needed) the append-only log file for the given UTC day."""
+    # Permissions only apply on creation: rw-r----- : NO EXECUTE
+    return open(
+        LOG_DIR / f"{day}.mpk", "ab",
+        buffering=LOG_BUFFER_SIZE,
+        opener=lambda path, flags: os.open(path, flags, 0o640)
+    )
+
+# Serializes rollover and appends across worker threads
+LOG_LOCK = threading.Lock()
+
+def write_log_frame(state, day: str, frame: bytes):
+    """Append frame(s) to the current log file, rolling over at UTC midnight."""
+    with LOG_LOCK:
+        if day != state.log_day:
+            # Open first: if that fails the old file stays usable and the
+            # next write tries the rollover again
+            new_file = open_log_file(day)
+            state.log_file.close()
+            state.log_file = new_file
+            state.log_day = day
+        state.log_file.write(frame)
+
+def flush_log_file(state):
+    """Push buffered frames in the current log file to disk."""
+    with LOG_LOCK:
+        state.log_file.flush()
+
+async def flush_periodically(app: FastAPI):
+    """Flush the log file every LOG_FLUSH_SECONDS so a crash loses at most that much."""
+    while True:
+        await asyncio.sleep(LOG_FLUSH_SECONDS)
+        try:
+            # Off the event loop: the flush may wait on the lock or the disk
+            await asyncio.to_thread(flush_log_file, app.state)
+        except (OSError, ValueError) as e:
+            # Keep going; a failed flush mustn't end the once-a-second guarantee
+            logger.error("Log flush failed: %s", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Keep the current day's log file open for the lifetime of the service."""
+    LOG_DIR.mkdir(exist_ok=True, mode=0o750)  # rwxr-x--- for directory traversal only
+    app.state.log_day = datetime.utcnow().strftime("%Y%m%d")
+    app.state.log_file = open_log_file(app.state.log_day)
+    flush_task = asyncio.create_task(flush_periodically(app))
+    try:
+        yield
+    finally:
+        flush_task.cancel()
+        # Flushes whatever is still buffered
+        app.state.log_file.close()
 
 app = FastAPI(
     title="CTF Logger Service",
     description="Write-only logging service for CTF challenge",
     docs_url=None,  # Disable Swagger UI
-    redoc_url=None  # Disable ReDoc
+    redoc_url=None,  # Disable ReDoc
+    lifespan=lifespan
 )
 
-class LogEntry(BaseModel):
+class LogEntry(msgspec.Struct):
     """Log entry model with validation"""
-    code: str = Field(..., description="User-submitted code")
-    output: dict = Field(..., description="Response sent to user")
-    client_ip: str = Field(..., description="Client IP address")
-    user_agent: str = Field(default="", description="User agent string")
-    hmac_signature: str = Field(..., description="HMAC signature for authentication")
+    code: str  # User-submitted code
+    output: dict  # Response sent to user
+    client_ip: str  # Client IP address
+    user_agent: str = ""  # User agent string
+    ts: str = ""  # UTC time of the attempt, stamped by the main server
 
-def verify_hmac(data: dict, signature: str) -> bool:
+def verify_hmac(body: bytes, signature: str) -> bool:
     """Verify HMAC signature to ensure request is from authorized source"""
-    # Create a copy without the signature field
-    data_copy = {k: v for k, v in data.items() if k != "hmac_signature"}
-    message = json.dumps(data_copy, sort_keys=True)
-    expected_signature = hmac.new(
-        LOGGER_SECRET.encode(),
-        message.encode(),
-        hashlib.sha256
-    ).hexdigest()
+    # The signature covers the raw request body, so no re-serialization is needed
+    mac = HMAC_TEMPLATE.copy()
+    mac.update(body)
+    expected_signature = mac.hexdigest()
     
-    # Debug logging
-    if signature != expected_signature:
-        print(f"HMAC mismatch:", file=sys.stderr)
-        print(f"  Received: {signature[:16]}...", file=sys.stderr)
-        print(f"  Expected: {expected_signature[:16]}...", file=sys.stderr)
-        print(f"  Secret used: {LOGGER_SECRET[:8]}...", file=sys.stderr)
+    # Debug logging; skipped entirely in production
+    if DEBUG and signature != expected_signature:
+        logger.debug(
+            "HMAC mismatch: received %s..., expected %s..., secret used %s...",
+            signature[:16], expected_signature[:16], LOGGER_SECRET[:8]
+        )
     
-    return hmac.compare_digest(signature, expected_signature)
+    # Compared as bytes: header values are latin-1, and compare_digest raises
+    # on non-ASCII str input
+    return hmac.compare_digest(signature.encode("latin-1"), expected_signature.encode())
 
-@app.post("/log")
-async def log_entry(entry: LogEntry):
-    """
-    Write-only endpoint to log CTF attempts.
-    No read capability to prevent information disclosure if compromised.
-    """
-    # Verify HMAC signature (use model_dump instead of deprecated dict)
-    if not verify_hmac(entry.model_dump(), entry.hmac_signature):
-        print(f"HMAC verification failed for request from {entry.client_ip}", file=sys.stderr)
+async def read_body(request: Request) -> bytes:
+    """Read the raw request body on the event loop so the log endpoints can be sync"""
+    return await request.body()
+
+def check_signature(request: Request, body: bytes):
+    """Reject the request unless X-Signature matches the raw body"""
+    if not verify_hmac(body, request.headers.get("x-signature", "")):
+        client_host = request.client.host if request.client else "unknown"
+        logger.warning("HMAC verification failed for request from %s", client_host)
         raise HTTPException(status_code=403, detail="Invalid signature")
-    
-    # Generate timestamp
+
+def stringify_big_ints(value):
+    """Replace ints msgpack can't hold (outside 64 bits) with their decimal string"""
+    if isinstance(value, dict):
+        return {k: stringify_big_ints(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [stringify_big_ints(v) for v in value]
+    if isinstance(value, int) and not -2**63 <= value < 2**64:
+        return str(value)
+    return value
+
+def encode_frame(entry: LogEntry) -> tuple:
+    """Timestamp an entry and encode it as a length-prefixed msgpack frame"""
+    # Files are picked by receive time so rollover only ever moves forward
     timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f")
     
-    # Prepare metadata
-    metadata = {
-        "timestamp": datetime.utcnow().isoformat(),
+    # One frame per attempt: 4-byte big-endian length + msgpack payload.
+    # Success and mode are already in the output, so they aren't repeated
+    record = {
+        "ts": entry.ts or timestamp,
+        "received": timestamp,
         "client_ip": entry.client_ip,
         "user_agent": entry.user_agent,
-        "output_success": entry.output.get("success", False),
-        "mode": entry.output.get("mode", "unknown")
+        "code": entry.code,
+        "output": entry.output
     }
+    try:
+        payload = FRAME_ENCODER.encode(record)
+    except OverflowError:
+        record["output"] = stringify_big_ints(entry.output)
+        payload = FRAME_ENCODER.encode(record)
+    return timestamp, len(payload).to_bytes(4, "big") + payload
+
+# /log_batch bodies are split into raw entries first, so each one is
+# validated on its own and a bad entry can't take its batch down with it
+BATCH_DECODER = msgspec.json.Decoder(list[msgspec.Raw])
+ENTRY_DECODER = msgspec.json.Decoder(LogEntry)
+
+@app.post("/log")
+def log_entry(request: Request, body: bytes = Depends(read_body)):
+    """
+    Write-only endpoint to log CTF attempts.
+    No read capability to prevent information disclosure if compromised.
     
+    Runs in FastAPI's threadpool: HMAC, decoding and the disk write are all
+    blocking work that shouldn't hold up the event loop.
+    """
+    # Verify HMAC signature before parsing anything
+    check_signature(request, body)
+    
+    # Decode and validate straight from the body, bypassing FastAPI's Pydantic layer
     try:
-        # Create log directory if it doesn't exist
-        log_dir = Path("/logs")
-        log_dir.mkdir(exist_ok=True, mode=0o750)  # rwxr-x--- for directory traversal only
-        
-        # Write metadata file - NO EXECUTE PERMISSIONS
-        metadata_file = log_dir / f"{timestamp}-metadata.json"
-        metadata_file.write_text(json.dumps(metadata, indent=2))
-        metadata_file.chmod(0o640)  # rw-r----- : NO EXECUTE
+        entry = msgspec.json.decode(body, type=LogEntry)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    try:
+        timestamp, frame = encode_frame(entry)
+        write_log_frame(request.app.state, timestamp[:8], frame)
         
-        # Write input code - NO EXECUTE PERMISSIONS
-        input_file = log_dir / f"{timestamp}-input.txt"
-        input_file.write_text(entry.code)
-        input_file.chmod(0o640)  # rw-r----- : NO EXECUTE
+        logger.debug("Successfully logged entry at %s from %s", timestamp, entry.client_ip)
+        return {"status": "logged", "timestamp": timestamp}
         
-        # Write output - NO EXECUTE PERMISSIONS
-        output_file = log_dir / f"{timestamp}-output.json"
-        output_file.write_text(json.dumps(entry.output, indent=2))
-        output_file.chmod(0o640)  # rw-r----- : NO EXECUTE
+    except Exception as e:
+        # Full traceback only when debugging
+        logger.error("Logging error: %s: %s", type(e).__name__, e, exc_info=DEBUG)
+        raise HTTPException(status_code=500, detail="Logging failed")
+
+@app.post("/log_batch")
+def log_batch(request: Request, body: bytes = Depends(read_body)):
+    """
+    Write-only endpoint to log a batch of CTF attempts under one signature.
+    The body is a JSON array of entries, optionally gzip-encoded; the
+    signature covers the body exactly as sent.
+    """
+    # Verify HMAC signature before decompressing or parsing anything
+    check_signature(request, body)
+    
+    try:
+        if request.headers.get("content-encoding", "") == "gzip":
+            body = gzip.decompress(body)
+        raw_entries = BATCH_DECODER.decode(body)
+    except (OSError, EOFError, msgspec.DecodeError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    entries = []
+    rejected = 0
+    for raw in raw_entries:
+        try:
+            entries.append(ENTRY_DECODER.decode(raw))
+        except msgspec.DecodeError as e:
+            rejected += 1
+            logger.warning("Rejected invalid batch entry: %s", e)
+    if not entries:
+        return {"status": "logged", "count": 0, "rejected": rejected}
+    
+    try:
+        frames = [encode_frame(entry) for entry in entries]
+        # All frames go out in one write, filed under the first entry's day
+        first_timestamp = frames[0][0]
+        write_log_frame(request.app.state, first_timestamp[:8], b"".join(frame for _, frame in frames))
         
-        print(f"Successfully logged entry at {timestamp} from {entry.client_ip}", file=sys.stderr)
-        return {"status": "logged", "timestamp": timestamp}
+        logger.debug("Successfully logged %d entries starting at %s", len(frames), first_timestamp)
+        return {"status": "logged", "count": len(frames), "rejected": rejected, "timestamp": first_timestamp}
         
     except Exception as e:
-        # Log the actual error for debugging
-        print(f"Logging error: {type(e).__name__}: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
+        # Full traceback only when debugging
+        logger.error("Logging error: %s: %s", type(e).__name__, e, exc_info=DEBUG)
         raise HTTPException(status_code=500, detail="Logging failed")
 
 @app.get("/health")
@@ -137,4 +282,5 @@ if __name__ == "__main__":
     print(f"Running on http://0.0.0.0:9090")
     print("=" * 60)
     
-    uvicorn.run(app, host="0.0.0.0", port=9090, log_level="warning")
+    # uvloop event loop and httptools parser come with uvicorn[standard]
+    uvicorn.run(app, host="0.0.0.0", port=9090, log_level="warning", loop="uvloop", http="httptools")
@@ -1,3 +1,4 @@
+import ast
 import modal
 import traceback
 import sys
@@ -36,35 +37,18 @@ def run_untrusted_code(code: str) -> dict:
             # Create a namespace for execution
             exec_namespace = {}
             
-            # Try to compile the entire code block first
-            try:
-                # Try to compile as 'exec' mode (statements)
-                compiled = compile(code, '<string>', 'exec')
-                exec(compiled, exec_namespace)
-                
-                # If the last line looks like an expression, try to evaluate it
-                lines = code.split('\n')
-                if lines:
-                    last_line = lines[-1].strip()
-                    if last_line and not any(last_line.startswith(kw) for kw in 
-                        ['import ', 'from ', 'def ', 'class ', 'if ', 'for ', 'while ', 'with ', 'try:', 'except']):
-                        try:
-                            # Try to evaluate the last line as an expression IN THE SAME NAMESPACE
-                            result = eval(last_line, exec_namespace)
-                        except:
-                            # Last line wasn't an expression, that's fine
-                            result = None
-                    else:
-                        result = None
-                else:
-                    result = None
-            except SyntaxError:
-                # Maybe it's a single expression?
-                try:
-                    result = eval(code, exec_namespace)
-                except:
-                    # Re-raise the original error
-                    raise
+            # Parse once; a trailing expression statement becomes the result
+            tree = ast.parse(code, '<string>', 'exec')
+            last_expr = None
+            if tree.body and isinstance(tree.body[-1], ast.Expr):
+                last_expr = tree.body.pop()
+            
+            exec(compile(tree, '<string>', 'exec'), exec_namespace)
+            
+            if last_expr is not None:
+                # Evaluate the last expression IN THE SAME NAMESPACE
+                expression = ast.Expression(last_expr.value)
+                result = eval(compile(expression, '<string>', 'eval'), exec_namespace)
                     
     except Exception as e:
         error = f"{type(e).__name__}: {str(e)}\n{traceback.format_exc()}"
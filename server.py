@@ -7,11 +7,18 @@ Can run in two modes:
 """
 
 import os
-import json
 import sys
-import hashlib
+import gzip
+import time
+import asyncio
+import logging
 import hmac
+import json
+import importlib.util
 import httpx
+import orjson
+from contextlib import asynccontextmanager
+from datetime import datetime
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import HTMLResponse
 from pathlib import Path
@@ -46,12 +53,68 @@ except ImportError:
     print("The Docker image should have rfmodal pre-installed")
     sys.exit(1)
 
+# uvloop and httptools come with uvicorn[standard] and are required to serve
+if not all(importlib.util.find_spec(name) for name in ("uvloop", "httptools")):
+    print("Error: uvloop/httptools not found. Please install with: pip install 'uvicorn[standard]'")
+    sys.exit(1)
+
 # Check if running in vulnerable mode
 VULNERABLE_MODE = get_env("VULNERABLE", "false").lower() in ["true", "1", "yes"]
 
+# Process environment, resolved once rather than per request
+PORT = int(get_env("PORT", "80"))
+IN_DOCKER = os.path.exists("/.dockerenv") or bool(get_env("DOCKER_CONTAINER"))
+HOSTNAME = os.uname().nodename
+RFMODAL_VERSION = getattr(modal, "__version__", "unknown")
+MODAL_CONFIGURED = bool(get_env("MODAL_TOKEN_ID"))
+
+def compute_base_url() -> str:
+    """Use BASE_URL if set, otherwise auto-detect from the environment."""
+    base_url = get_env("BASE_URL")
+    if base_url:
+        return base_url
+    # In Docker, we're always on the internal port, external mapping handles the rest
+    if IN_DOCKER or PORT == 80:
+        return "http://localhost"
+    # Running directly
+    return f"http://localhost:{PORT}"
+
+BASE_URL = compute_base_url()
+
 # Logger configuration
 LOGGER_URL = get_env("LOGGER_URL")
+LOGGING_ENABLED = bool(LOGGER_URL)
 LOGGER_SECRET = get_env("LOGGER_SECRET", "default-secret-change-me")
+# HMAC keyed once; copy() per message avoids redoing the key setup
+HMAC_TEMPLATE = hmac.new(LOGGER_SECRET.encode(), digestmod="sha256")
+
+# Sidecar diagnostics beyond warnings are only emitted when DEBUG is set
+DEBUG = get_env("DEBUG", "false").lower() in ["true", "1", "yes"]
+logging.basicConfig(
+    stream=sys.stderr,
+    level=logging.DEBUG if DEBUG else logging.WARNING,
+    format="%(levelname)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# After a failed post, sidecar logging pauses for this long rather than
+# piling more timeouts onto a logger that is down; attempts queue up meanwhile
+LOGGER_BACKOFF_SECONDS = 10.0
+_logger_retry_at = 0.0
+
+# Attempts are queued and posted to the sidecar in batches of up to
+# LOG_BATCH_SIZE, waiting at most LOG_BATCH_WAIT_SECONDS to fill one
+LOG_BATCH_SIZE = 64
+LOG_BATCH_WAIT_SECONDS = 0.25
+# Entries are encoded as they're queued, and the queue is capped by both
+# count and bytes since code and output are attacker-sized; past either
+# cap new entries are dropped and counted
+LOG_QUEUE_SIZE = 2000
+LOG_QUEUE_MAX_BYTES = 16 * 1024 * 1024
+# How long shutdown waits for queued entries to reach the sidecar
+LOG_SHUTDOWN_SECONDS = 5.0
+# Batch bodies larger than this are gzipped before signing
+LOG_COMPRESS_THRESHOLD = 1024
 
 # Set the FLAG environment variable for the CTF
 FLAG = get_env("FLAG")
@@ -64,79 +127,226 @@ else:
     # Update the environment variable with the cleaned value
     os.environ["FLAG"] = FLAG
 
+def dump_json(content) -> bytes:
+    """Serialize with orjson, falling back to stdlib json for what orjson rejects."""
+    try:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # e.g. results with ints outside 64 bits, which stdlib json handles
+        return json.dumps(content, separators=(",", ":")).encode()
+
+def dump_log_entry(entry: dict) -> bytes:
+    """Serialize a log entry as UTF-8 JSON the logger can always decode."""
+    try:
+        return orjson.dumps(entry, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # Lone surrogates become "?" rather than \ud8xx escapes, which the
+        # logger would reject along with the rest of its batch
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":")).encode("utf-8", "replace")
+
+class ORJSONResponse(Response):
+    """JSON response rendered straight to bytes by orjson."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+# How often the Modal function handle is re-resolved in the background
+MODAL_REFRESH_SECONDS = 300
+
+def lookup_modal_function():
+    """Get the Modal function with appropriate firewall setting (not yet hydrated)."""
+    return modal.Function.from_name(
+        "modal-ctf-challenge", 
+        "run_untrusted_code",
+        use_firewall=not VULNERABLE_MODE  # Enable firewall unless in vulnerable mode
+    )
+
+async def refresh_modal_function(app: FastAPI):
+    """Keep a freshly hydrated handle in app.state so lookups never land on a request."""
+    while True:
+        await asyncio.sleep(MODAL_REFRESH_SECONDS)
+        try:
+            modal_function = lookup_modal_function()
+            await modal_function.hydrate.aio()
+        except Exception as e:
+            logger.warning("Modal function refresh failed, keeping current handle: %s: %s", type(e).__name__, e)
+            continue
+        app.state.modal_function = modal_function
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up per-process resources shared by all requests."""
+    app.state.modal_function = lookup_modal_function()
+    
+    # Look it up now so a missing deployment or bad token fails startup
+    # instead of the first /execute request
+    try:
+        await app.state.modal_function.hydrate.aio()
+    except Exception as e:
+        print(f"Error: could not resolve Modal function modal-ctf-challenge/run_untrusted_code: {type(e).__name__}: {e}")
+        print("Deploy it with ./deploy_modal.sh and check MODAL_TOKEN_ID/MODAL_TOKEN_SECRET")
+        raise
+    refresh_task = asyncio.create_task(refresh_modal_function(app))
+    
+    # One pooled client for the logger sidecar, so log posts reuse connections.
+    # Limits stay well under the container's 1024 file descriptor ulimit
+    app.state.http = httpx.AsyncClient(
+        timeout=5.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=15.0)
+    )
+    # Unbounded so the shutdown sentinel always fits; queue_log_entry enforces the caps
+    app.state.log_queue = asyncio.Queue()
+    app.state.log_queue_bytes = 0
+    app.state.log_dropped = 0
+    app.state.log_stopping = asyncio.Event()
+    log_task = asyncio.create_task(log_batch_worker(app)) if LOGGING_ENABLED else None
+    try:
+        yield
+    finally:
+        refresh_task.cancel()
+        if log_task is not None:
+            # None tells the worker to send what it has and stop; it skips
+            # backoff waits from here on, and gets a bounded time to finish
+            app.state.log_stopping.set()
+            app.state.log_queue.put_nowait(None)
+            try:
+                await asyncio.wait_for(log_task, LOG_SHUTDOWN_SECONDS)
+            except asyncio.TimeoutError:
+                left = 0
+                while not app.state.log_queue.empty():
+                    left += app.state.log_queue.get_nowait() is not None
+                logger.warning("Log flush timed out at shutdown, dropped %d queued entries", left)
+        await app.state.http.aclose()
+
 # Create FastAPI app
 app = FastAPI(
     title="Modal CTF Challenge",
-    description=f"Running in {'VULNERABLE' if VULNERABLE_MODE else 'SECURE'} mode"
+    description=f"Running in {'VULNERABLE' if VULNERABLE_MODE else 'SECURE'} mode",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-async def log_to_sidecar(code: str, output: dict, client_ip: str, user_agent: str):
-    """Send log entry to the logger sidecar service"""
-    if not LOGGER_URL:
-        print(f"Logger not configured - LOGGER_URL is empty", file=sys.stderr)
-        return  # Logger not configured
-    
+def queue_log_entry(app: FastAPI, code: str, output: dict, client_ip: str, user_agent: str):
+    """Queue an attempt for the next batch sent to the logger sidecar"""
     try:
-        # Prepare data for HMAC
-        log_data = {
+        entry = dump_log_entry({
+            # Stamped now: the entry may sit in the queue through a backoff
+            "ts": datetime.utcnow().strftime("%Y%m%d_%H%M%S_%f"),
             "code": code,
             "output": output,
             "client_ip": client_ip,
             "user_agent": user_agent
-        }
+        })
+    except (TypeError, ValueError) as e:
+        logger.warning("Dropping unserializable log entry from %s: %s", client_ip, e)
+        return
+    
+    state = app.state
+    if state.log_queue.qsize() >= LOG_QUEUE_SIZE or state.log_queue_bytes + len(entry) > LOG_QUEUE_MAX_BYTES:
+        # Counted here, reported by the worker, so a flood doesn't flood stderr too
+        state.log_dropped += 1
+        return
+    state.log_queue.put_nowait(entry)
+    state.log_queue_bytes += len(entry)
+
+def report_dropped(app: FastAPI):
+    """Warn once about entries dropped because the log queue was full"""
+    if app.state.log_dropped:
+        logger.warning("Log queue full, dropped %d entries", app.state.log_dropped)
+        app.state.log_dropped = 0
+
+async def log_batch_worker(app: FastAPI):
+    """Drain the log queue, posting up to LOG_BATCH_SIZE entries at a time"""
+    queue = app.state.log_queue
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        entry = await queue.get()
+        if entry is None:
+            break
+        batch = [entry]
         
-        # Calculate HMAC signature
-        message = json.dumps(log_data, sort_keys=True)
-        signature = hmac.new(
-            LOGGER_SECRET.encode(),
-            message.encode(),
-            hashlib.sha256
-        ).hexdigest()
+        # Keep collecting until the batch is full or the wait window closes
+        deadline = loop.time() + LOG_BATCH_WAIT_SECONDS
+        while len(batch) < LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                entry = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if entry is None:
+                stopping = True
+                break
+            batch.append(entry)
+        app.state.log_queue_bytes -= sum(map(len, batch))
         
-        # Add signature to data
-        log_data["hmac_signature"] = signature
+        # One transient failure shouldn't cost the whole batch: try it once more
+        if not await send_log_batch(app, batch):
+            if not await send_log_batch(app, batch):
+                logger.warning("Dropped %d log entries after a failed retry", len(batch))
+        report_dropped(app)
+    report_dropped(app)
+
+async def send_log_batch(app: FastAPI, batch: list) -> bool:
+    """Send a batch of encoded log entries to the logger sidecar service.
+    
+    Returns False only for transport errors and 5xx replies, which are
+    worth retrying; a 4xx would be rejected again.
+    """
+    global _logger_retry_at
+    delay = _logger_retry_at - time.monotonic()
+    if delay > 0:
+        # Wait out a backoff instead of dropping; the queue holds attempts
+        # meanwhile. Shutdown cuts the wait short and gives up on the batch
+        logger.debug("Logger backing off after a failure, waiting %.1fs", delay)
+        try:
+            await asyncio.wait_for(app.state.log_stopping.wait(), delay)
+            return False
+        except asyncio.TimeoutError:
+            pass
+    
+    try:
+        # Entries were encoded as they were queued; the logger verifies this exact body
+        body = b"[" + b",".join(batch) + b"]"
+        headers = {"Content-Type": "application/json"}
+        if len(body) > LOG_COMPRESS_THRESHOLD:
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
         
-        print(f"Sending log to {LOGGER_URL}/log with signature {signature[:8]}...", file=sys.stderr)
+        # One HMAC signature over the raw (possibly compressed) body covers the batch
+        mac = HMAC_TEMPLATE.copy()
+        mac.update(body)
+        headers["X-Signature"] = mac.hexdigest()
         
         # Send to logger service
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{LOGGER_URL}/log",
-                json=log_data,
-                timeout=5.0  # Increased timeout
-            )
-            if response.status_code != 200:
-                print(f"Logger returned status {response.status_code}: {response.text}", file=sys.stderr)
-            else:
-                print(f"Successfully logged to sidecar", file=sys.stderr)
+        response = await app.state.http.post(
+            f"{LOGGER_URL}/log_batch",
+            content=body,
+            headers=headers,
+            timeout=5.0  # Increased timeout
+        )
+        if response.status_code != 200:
+            logger.warning("Logger returned status %s for %d entries: %s", response.status_code, len(batch), response.text)
+            return response.status_code < 500
+        logger.debug("Successfully logged %d entries to sidecar", len(batch))
+        return True
     except Exception as e:
-        # Log the actual error for debugging
-        print(f"Logger error (non-critical): {type(e).__name__}: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
+        # Non-critical: one line, then stop trying for a while
+        logger.warning("Logger post failed (non-critical): %s: %s", type(e).__name__, e)
+        _logger_retry_at = time.monotonic() + LOGGER_BACKOFF_SECONDS
+        return False
 
-# Serve static files from public directory
-@app.get("/", response_class=HTMLResponse)
-async def root():
+def render_index() -> bytes:
+    """Render public/index.html with the base URL and mode banner filled in."""
     html_path = Path("public/index.html")
     if html_path.exists():
         content = html_path.read_text()
         
-        # Determine the base URL
-        base_url = get_env("BASE_URL")
-        if not base_url:
-            # Auto-detect based on environment
-            port = get_env("PORT", "80")
-            # In Docker, we're always on the internal port, external mapping handles the rest
-            if os.path.exists("/.dockerenv") or get_env("DOCKER_CONTAINER"):
-                # Running in Docker
-                base_url = "http://localhost"
-            else:
-                # Running directly
-                base_url = f"http://localhost:{port}" if port != "80" else "http://localhost"
-        
         # Replace placeholder with actual URL
-        content = content.replace("[YOUR_URL]", base_url)
+        content = content.replace("[YOUR_URL]", BASE_URL)
         
         # Update the description based on mode
         if not VULNERABLE_MODE:
@@ -148,8 +358,16 @@ async def root():
             content = content.replace('<h1>🚩 Modal CTF Challenge - Capture the Flag! 🚩</h1>', 
                                     f'<h1>🚩 Modal CTF Challenge - Capture the Flag! 🚩</h1>\n    {secure_note}')
         
-        return content
-    return "<h1>Error: public/index.html not found</h1>"
+        return content.encode()
+    return b"<h1>Error: public/index.html not found</h1>"
+
+# The page only depends on startup config, so render it once per process
+_CACHED_HTML = render_index()
+
+# Serve static files from public directory
+@app.get("/", response_class=HTMLResponse)
+async def root():
+    return HTMLResponse(_CACHED_HTML)
 
 @app.post("/execute")
 async def execute_code(request: Request):
@@ -165,30 +383,29 @@ async def execute_code(request: Request):
     # Get client info for logging
     client_ip = request.client.host if request.client else "unknown"
     user_agent = request.headers.get("user-agent", "")
+    code = ""
     
     try:
-        # Handle both raw text and JSON input
+        # Handle both raw text and JSON input; the body is read exactly once
+        body_bytes = await request.body()
         content_type = request.headers.get("content-type", "").lower()
         
         if "application/json" in content_type:
-            body = await request.json()
-            code = body.get("code", "")
+            submitted = orjson.loads(body_bytes).get("code", "")
+            if not isinstance(submitted, str):
+                raise TypeError(f"code must be a string, not {type(submitted).__name__}")
+            code = submitted
         else:
             # Treat as raw text/plain
-            body_bytes = await request.body()
             code = body_bytes.decode("utf-8")
         
-        # Get the Modal function with appropriate firewall setting
-        modal_function = modal.Function.from_name(
-            "modal-ctf-challenge", 
-            "run_untrusted_code",
-            use_firewall=not VULNERABLE_MODE  # Enable firewall unless in vulnerable mode
-        )
+        # Shared handle, hydrated at startup and refreshed in the background
+        modal_function = request.app.state.modal_function
         
-        # Call the Modal function remotely
+        # Call the Modal function remotely without blocking the event loop
         # In secure mode, rfmodal's firewall will block malicious pickle operations
         # In vulnerable mode, the attack will work as before
-        result = modal_function.remote(code)
+        result = await modal_function.remote.aio(code)
         
         response_data = {
             "success": True,
@@ -198,12 +415,15 @@ async def execute_code(request: Request):
             "mode": "vulnerable" if VULNERABLE_MODE else "secure"
         }
         
-        # Log the attempt
-        await log_to_sidecar(code, response_data, client_ip, user_agent)
+        # Render before logging so a result that can't be serialized is
+        # logged once, as the failure below, rather than twice
+        response = ORJSONResponse(response_data)
         
-        # Return pretty-printed JSON
-        pretty_json = json.dumps(response_data, indent=2)
-        return Response(content=pretty_json, media_type="application/json")
+        # Log the attempt; the batch worker sends it to the sidecar
+        if LOGGING_ENABLED:
+            queue_log_entry(request.app, code, response_data, client_ip, user_agent)
+        
+        return response
         
     except Exception as e:
         # Check if this is a firewall-blocked pickle operation
@@ -221,42 +441,47 @@ async def execute_code(request: Request):
         if is_firewall_block and not VULNERABLE_MODE:
             response_data["hint"] = "The pickle firewall blocked your attack. This is expected in secure mode!"
         
-        # Log the attempt
-        await log_to_sidecar(code, response_data, client_ip, user_agent)
+        # Log the attempt; the batch worker sends it to the sidecar
+        if LOGGING_ENABLED:
+            queue_log_entry(request.app, code, response_data, client_ip, user_agent)
         
-        pretty_json = json.dumps(response_data, indent=2)
-        return Response(content=pretty_json, media_type="application/json", status_code=500)
+        return ORJSONResponse(response_data, status_code=500)
+
+# The health and mode payloads are fixed for the life of the process, so
+# serialize them once instead of rebuilding them on every probe
+_HEALTH_BYTES = orjson.dumps({
+    "status": "healthy",
+    "mode": "vulnerable" if VULNERABLE_MODE else "secure",
+    "firewall_enabled": not VULNERABLE_MODE,
+    "flag_configured": bool(FLAG),
+    "modal_configured": MODAL_CONFIGURED,
+    "container": IN_DOCKER,
+    "hostname": HOSTNAME,
+    "rfmodal_version": RFMODAL_VERSION,
+    "logger_configured": LOGGING_ENABLED
+})
+
+_MODE_BYTES = orjson.dumps({
+    "mode": "vulnerable" if VULNERABLE_MODE else "secure",
+    "firewall_enabled": not VULNERABLE_MODE,
+    "description": "Pickle attacks WILL work" if VULNERABLE_MODE else "Pickle attacks are BLOCKED"
+})
 
 @app.get("/health")
 async def health():
     """Health check endpoint."""
-    return {
-        "status": "healthy",
-        "mode": "vulnerable" if VULNERABLE_MODE else "secure",
-        "firewall_enabled": not VULNERABLE_MODE,
-        "flag_configured": bool(FLAG),
-        "modal_configured": bool(get_env("MODAL_TOKEN_ID")),
-        "container": os.path.exists("/.dockerenv") or bool(get_env("DOCKER_CONTAINER")),
-        "hostname": os.uname().nodename,
-        "rfmodal_version": getattr(modal, "__version__", "unknown"),
-        "logger_configured": bool(LOGGER_URL)
-    }
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
 
 @app.get("/mode")
 async def mode():
     """Get current security mode."""
-    return {
-        "mode": "vulnerable" if VULNERABLE_MODE else "secure",
-        "firewall_enabled": not VULNERABLE_MODE,
-        "description": "Pickle attacks WILL work" if VULNERABLE_MODE else "Pickle attacks are BLOCKED"
-    }
+    return Response(content=_MODE_BYTES, media_type="application/json")
 
 if __name__ == "__main__":
-    port = int(get_env("PORT", "80"))
     base_url = get_env("BASE_URL")
     
-    # Detect if running in Docker
-    in_docker = os.path.exists("/.dockerenv") or get_env("DOCKER_CONTAINER")
+    # One event loop per process; defaults to one worker per CPU
+    workers = int(get_env("WORKERS", str(os.cpu_count() or 1)))
     
     print("=" * 60)
     print("Modal CTF Challenge - Local Server")
@@ -265,10 +490,11 @@ if __name__ == "__main__":
     print(f"Pickle Firewall: {'DISABLED ⚠️' if VULNERABLE_MODE else 'ENABLED ✅'}")
     print(f"FLAG is set to: {FLAG}")
     print(f"Running as user: {get_env('USER', 'unknown')}")
-    print(f"Hostname: {os.uname().nodename}")
-    print(f"Container: {'Yes (Docker)' if in_docker else 'No (Direct)'}")
+    print(f"Hostname: {HOSTNAME}")
+    print(f"Container: {'Yes (Docker)' if IN_DOCKER else 'No (Direct)'}")
     print(f"Python version: {sys.version}")
-    print(f"Logger: {'Configured' if LOGGER_URL else 'Not configured'}")
+    print(f"Workers: {workers}")
+    print(f"Logger: {'Configured' if LOGGING_ENABLED else 'Not configured'}")
     print(f"Logger URL: {LOGGER_URL if LOGGER_URL else 'Not set'}")
     print(f"Logger Secret: {LOGGER_SECRET[:8]}..." if LOGGER_SECRET else "Not set")
     if base_url:
@@ -284,13 +510,13 @@ if __name__ == "__main__":
         print("   Standard pickle attacks will be blocked")
     
     print()
-    print(f"Starting server on http://0.0.0.0:{port}")
+    print(f"Starting server on http://0.0.0.0:{PORT}")
     if base_url:
         print(f"Public access: {base_url}")
     print("=" * 60)
     
     # Note: Port 80 requires sudo on most systems when not in Docker
-    if port < 1024 and os.geteuid() != 0 and not in_docker:
+    if PORT < 1024 and os.geteuid() != 0 and not IN_DOCKER:
         print("\n⚠️  WARNING: Port 80 requires root privileges!")
         print("   Run with: sudo python3 server.py")
         print("   Or set PORT=8000 for non-privileged port")
@@ -298,4 +524,10 @@ if __name__ == "__main__":
     # Flush output for Docker logs
     sys.stdout.flush()
     
-    uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
+    # Multiple workers need an import string so each process loads its own app;
+    # the lifespan then sets up the Modal handle and HTTP client per worker
+    # Access logging is off: it formats and writes a line on every request
+    uvicorn.run(
+        app if workers == 1 else "server:app", host="0.0.0.0", port=PORT, log_level="info",
+        loop="uvloop", http="httptools", access_log=False, workers=workers
+    )